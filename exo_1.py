@@ -2,7 +2,9 @@ import logging
 import os
 from datetime import datetime
 
+import numpy as np
 import pandas as pd
+from openpyxl import load_workbook
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
@@ -18,6 +20,9 @@ def read_and_clean_excel(path, sheet_name):
     """
     Reads an Excel file and removes duplicates based on the specified columns.
 
+    The workbook is opened in read-only mode so that rows are streamed from the
+    sheet instead of loading the whole workbook into memory.
+
     Args:
     - path (str): Path to the Excel file.
     - sheet_name (str): Name of the sheet to read.
@@ -26,9 +31,17 @@ def read_and_clean_excel(path, sheet_name):
     - pd.DataFrame: Cleaned DataFrame without duplicates.
     """
     try:
-        export_patient = pd.read_excel(
-            path, sheet_name=sheet_name, dtype={"HOSPITAL_PATIENT_ID": str}
-        )
+        workbook = load_workbook(path, read_only=True, data_only=True)
+        try:
+            rows = workbook[sheet_name].iter_rows(values_only=True)
+            columns = next(rows)
+            export_patient = pd.DataFrame(list(rows), columns=columns, dtype=object)
+        finally:
+            workbook.close()
+        export_patient = export_patient.dropna(how="all")
+        export_patient["HOSPITAL_PATIENT_ID"] = export_patient[
+            "HOSPITAL_PATIENT_ID"
+        ].map(str, na_action="ignore")
         export_patient_cleaned = export_patient.drop_duplicates(
             subset=["NOM", "PRENOM", "DATE_NAISSANCE", "ADRESSE", "TEL"]
         )
@@ -38,177 +51,193 @@ def read_and_clean_excel(path, sheet_name):
         return None
 
 
-def create_patient_dict(index, row, upload_id):
+def get_patient_data(export_patient, upload_id):
     """
-    Creates a dictionary for a patient from a row of the DataFrame.
+    Builds the patient and IPPHIST records from the DataFrame.
+
+    Columns are computed on the whole DataFrame at once rather than row by row.
+    PATIENT_NUM is a hash of the patient's IPP (HOSPITAL_PATIENT_ID), which does
+    not change when their address or phone number does, so a patient keeps the
+    same number across uploads.
 
     Args:
-    - index (int): Index of the row.
-    - row (pd.Series): Row of the DataFrame.
+    - export_patient (pd.DataFrame): DataFrame containing patient data.
     - upload_id (int): Upload ID.
 
     Returns:
-    - dict: Dictionary containing patient information.
+    - (pd.DataFrame, pd.DataFrame): DataFrames for patients and IPPHIST records.
     """
-    patient_num = index + 1
-    birth_date = row["DATE_NAISSANCE"]
-    death_date = row["DATE_MORT"] if pd.notna(row["DATE_MORT"]) else None
-
-    patient_dict = {
-        "PATIENT_NUM": patient_num,
-        "LASTNAME": row["NOM"],
-        "FIRSTNAME": row["PRENOM"],
-        "BIRTH_DATE": birth_date,
-        "SEX": row["SEXE"],
-        "MAIDEN_NAME": (
-            row["NOM_JEUNE_FILLE"] if pd.notna(row["NOM_JEUNE_FILLE"]) else None
-        ),
-        "RESIDENCE_ADDRESS": row["ADRESSE"],
-        "PHONE_NUMBER": row["TEL"],
-        "ZIP_CODE": row["CP"],
-        "RESIDENCE_CITY": row["VILLE"],
-        "DEATH_DATE": death_date,
-        "RESIDENCE_COUNTRY": row["PAYS"],
-        "RESIDENCE_LATITUDE": None,
-        "RESIDENCE_LONGITUDE": None,
-        "DEATH_CODE": "1" if death_date else "0",
-        "UPDATE_DATE": datetime.now().strftime("%d/%m/%Y"),
-        "BIRTH_COUNTRY": None,
-        "BIRTH_CITY": None,
-        "BIRTH_ZIP_CODE": None,
-        "BIRTH_LATITUDE": None,
-        "BIRTH_LONGITUDE": None,
-        "UPLOAD_ID": upload_id,
-    }
-
-    return patient_dict
-
-
-def create_ipphist_dict(index, row, upload_id):
+    identity_hash = pd.util.hash_pandas_object(
+        export_patient[["HOSPITAL_PATIENT_ID"]], index=False
+    ).to_numpy()
+    patient_num = (identity_hash >> np.uint64(1)).astype(np.int64)
+    death_date = export_patient["DATE_MORT"]
+    maiden_name = export_patient["NOM_JEUNE_FILLE"]
+    hospital_patient_id = export_patient["HOSPITAL_PATIENT_ID"]
+
+    df_patients = pd.DataFrame(
+        {
+            "PATIENT_NUM": patient_num,
+            "LASTNAME": export_patient["NOM"].to_numpy(),
+            "FIRSTNAME": export_patient["PRENOM"].to_numpy(),
+            "BIRTH_DATE": export_patient["DATE_NAISSANCE"].to_numpy(),
+            "SEX": export_patient["SEXE"].to_numpy(),
+            "MAIDEN_NAME": maiden_name.astype(object)
+            .where(maiden_name.notna(), None)
+            .to_numpy(),
+            "RESIDENCE_ADDRESS": export_patient["ADRESSE"].to_numpy(),
+            "PHONE_NUMBER": export_patient["TEL"].to_numpy(),
+            "ZIP_CODE": export_patient["CP"].to_numpy(),
+            "RESIDENCE_CITY": export_patient["VILLE"].to_numpy(),
+            "DEATH_DATE": death_date.astype(object)
+            .where(death_date.notna(), None)
+            .to_numpy(),
+            "RESIDENCE_COUNTRY": export_patient["PAYS"].to_numpy(),
+            "RESIDENCE_LATITUDE": None,
+            "RESIDENCE_LONGITUDE": None,
+            "DEATH_CODE": np.where(death_date.notna(), "1", "0"),
+            "UPDATE_DATE": datetime.now().strftime("%d/%m/%Y"),
+            "BIRTH_COUNTRY": None,
+            "BIRTH_CITY": None,
+            "BIRTH_ZIP_CODE": None,
+            "BIRTH_LATITUDE": None,
+            "BIRTH_LONGITUDE": None,
+            "UPLOAD_ID": upload_id,
+        }
+    )
+
+    df_ipphist = pd.DataFrame(
+        {
+            "PATIENT_NUM": patient_num,
+            "HOSPITAL_PATIENT_ID": hospital_patient_id.to_numpy(),
+            "ORIGIN_PATIENT_ID": "SIH",
+            "MASTER_PATIENT_ID": np.where(hospital_patient_id.astype(bool), "1", "0"),
+            "UPLOAD_ID": upload_id,
+        }
+    )
+
+    return df_patients, df_ipphist
+
+
+def upsert_rows(rows, columns, table_name, key, conn):
     """
-    Creates a dictionary for an IPPHIST record from a row of the DataFrame.
+    Inserts or updates rows in a database table.
+
+    Rows whose key already exists in the table are updated in place, the
+    others are inserted. All rows are sent in a single executemany call within
+    one transaction.
 
     Args:
-    - index (int): Index of the row.
-    - row (pd.Series): Row of the DataFrame.
-    - upload_id (int): Upload ID.
+    - rows (iterable): The rows to write, as tuples ordered like columns.
+    - columns (list): The names of the columns.
+    - table_name (str): The name of the target table.
+    - key (str): The name of the key column, which must be unique in the table.
+    - conn (sqlite3.Connection): The connection to the database.
 
     Returns:
-    - dict: Dictionary containing IPPHIST information.
-    """
-    patient_num = index + 1
-
-    ipphist_dict = {
-        "PATIENT_NUM": patient_num,
-        "HOSPITAL_PATIENT_ID": row["HOSPITAL_PATIENT_ID"],
-        "ORIGIN_PATIENT_ID": "SIH",
-        "MASTER_PATIENT_ID": "1" if row["HOSPITAL_PATIENT_ID"] else "0",
-        "UPLOAD_ID": upload_id,
-    }
-
-    return ipphist_dict
-
-
-def get_patient_data(export_patient, upload_id):
+    - None
     """
-    Extracts patient and IPPHIST record data from the DataFrame.
+    assignments = ", ".join(f"{col} = excluded.{col}" for col in columns if col != key)
+    query = (
+        f"INSERT INTO {table_name} ({', '.join(columns)}) "
+        f"VALUES ({', '.join('?' for _ in columns)}) "
+        f"ON CONFLICT({key}) DO UPDATE SET {assignments}"
+    )
+    with conn:
+        conn.executemany(query, rows)
 
-    Args:
-    - export_patient (pd.DataFrame): DataFrame containing patient data.
-    - upload_id (int): Upload ID.
 
-    Returns:
-    - (list, list): List of dictionaries for patients and IPPHIST records.
-    """
-    patients_data = [
-        create_patient_dict(index, row, upload_id)
-        for index, row in export_patient.iterrows()
-    ]
-    ipphist_data = [
-        create_ipphist_dict(index, row, upload_id)
-        for index, row in export_patient.iterrows()
-    ]
-    return patients_data, ipphist_data
-
-
-def update_existing_data(df, table_name, conn):
+def upsert_data(df, table_name, key, conn):
     """
-    Updates existing records in a database table with data from a DataFrame.
+    Inserts or updates the rows of a DataFrame in a database table.
 
     Args:
-    - df (pd.DataFrame): The DataFrame containing the data to update.
+    - df (pd.DataFrame): The DataFrame containing the data to write.
     - table_name (str): The name of the target table.
+    - key (str): The name of the key column, which must be unique in the table.
     - conn (sqlite3.Connection): The connection to the database.
 
     Returns:
     - None
     """
-    for _, row in df.iterrows():
-        placeholders = ", ".join(
-            [f"{col} = ?" for col in row.index if col != "PATIENT_NUM"]
-        )
-        query = f"UPDATE {table_name} SET {placeholders} WHERE PATIENT_NUM = ?"
-        params = tuple(row[col] for col in row.index if col != "PATIENT_NUM") + (
-            row["PATIENT_NUM"],
-        )
-        conn.execute(query, params)
-    conn.commit()
+    if df.empty:
+        return
+
+    rows = df.itertuples(index=False, name=None)
+    upsert_rows(rows, list(df.columns), table_name, key, conn)
 
 
-def insert_new_data(df, table_name, conn):
+def delete_stale_data(keys, table_name, key, conn):
     """
-    Inserts a DataFrame into a database table.
+    Deletes the rows of a database table whose key is not in the given keys.
+
+    Nothing is deleted when keys is empty, so an empty source cannot wipe the
+    table.
 
     Args:
-    - df (pd.DataFrame): The DataFrame containing the data to insert.
+    - keys (iterable): The keys of the rows to keep.
     - table_name (str): The name of the target table.
+    - key (str): The name of the key column.
     - conn (sqlite3.Connection): The connection to the database.
 
     Returns:
     - None
     """
-    df.to_sql(table_name, con=conn, if_exists="append", index=False)
+    keys = [(k,) for k in keys]
+    if not keys:
+        return
+
+    with conn:
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS CURRENT_KEYS (KEY PRIMARY KEY)")
+        conn.execute("DELETE FROM CURRENT_KEYS")
+        conn.executemany("INSERT OR IGNORE INTO CURRENT_KEYS VALUES (?)", keys)
+        conn.execute(
+            f"DELETE FROM {table_name} WHERE {key} NOT IN (SELECT KEY FROM CURRENT_KEYS)"
+        )
+        conn.execute("DELETE FROM CURRENT_KEYS")
 
 
 def update_patient_data(upload_id, conn):
     """
     Updates patient and IPPHIST data in the database.
 
+    The export is a full snapshot: rows whose PATIENT_NUM is no longer produced
+    by it, including rows keyed by an older numbering, are deleted.
+
     Args:
     - upload_id (int): The upload ID to associate with the records.
     - conn (sqlite3.Connection): The connection to the database.
 
     Returns:
-    - None
+    - bool: True if the tables were updated, False otherwise.
     """
     try:
         logging.info("Reading data from the Excel file...")
         export_patient = read_and_clean_excel(path, sheet_name)
         if export_patient is None:
             logging.error("The Excel file could not be read properly. Update aborted.")
-            return
+            return False
         logging.info("Data reading successful.")
 
-        patients_data, ipphist_data = get_patient_data(export_patient, upload_id)
-        df_patients = pd.DataFrame(patients_data)
-        df_ipphist = pd.DataFrame(ipphist_data)
-
-        existing_patients = pd.read_sql_query("SELECT * FROM DWH_PATIENT", conn)
-        existing_ipphist = pd.read_sql_query("SELECT * FROM DWH_PATIENT_IPPHIST", conn)
+        df_patients, df_ipphist = get_patient_data(export_patient, upload_id)
+        duplicated_nums = df_patients["PATIENT_NUM"].duplicated()
+        if duplicated_nums.any():
+            logging.error(
+                f"{duplicated_nums.sum()} patients share a PATIENT_NUM with another "
+                "patient. Update aborted."
+            )
+            return False
 
-        new_patients = df_patients[
-            ~df_patients["PATIENT_NUM"].isin(existing_patients["PATIENT_NUM"])
-        ]
-        new_ipphist = df_ipphist[
-            ~df_ipphist["PATIENT_NUM"].isin(existing_ipphist["PATIENT_NUM"])
-        ]
+        upsert_data(df_patients, "DWH_PATIENT", "PATIENT_NUM", conn)
+        upsert_data(df_ipphist, "DWH_PATIENT_IPPHIST", "PATIENT_NUM", conn)
 
-        update_existing_data(df_patients, "DWH_PATIENT", conn)
-        update_existing_data(df_ipphist, "DWH_PATIENT_IPPHIST", conn)
-        insert_new_data(new_patients, "DWH_PATIENT", conn)
-        insert_new_data(new_ipphist, "DWH_PATIENT_IPPHIST", conn)
+        patient_nums = df_patients["PATIENT_NUM"].tolist()
+        delete_stale_data(patient_nums, "DWH_PATIENT", "PATIENT_NUM", conn)
+        delete_stale_data(patient_nums, "DWH_PATIENT_IPPHIST", "PATIENT_NUM", conn)
 
         logging.info("Update successful.")
+        return True
 
     except Exception as e:
         logging.error(f"Error updating DWH_PATIENT and DWH_PATIENT_IPPHIST tables: {e}")
+        return False
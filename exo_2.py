@@ -1,19 +1,33 @@
+import hashlib
 import logging
 import os
 import re
+import shelve
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
-import pandas as pd
 import pymupdf
 from docx import Document
 from lxml import etree
 
-from exo_1 import insert_new_data
+from exo_1 import delete_stale_data, upsert_rows
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
+WHITESPACE_PATTERN = re.compile(r"\s+")
+METADATA_PATTERN = re.compile(
+    r"\b(?P<date>\d{2}/\d{2}/\d{4})\b"
+    r"|\b(?P<prefix>dr)\s+(?P<author>[a-z]+(?:\s+[a-z]+)?)\b"
+)
+SQLITE_MAX_VARIABLES = 999
+TEXT_CACHE_PATH = "text_cache"
+TEXTBOX_TEXT_XPATH = etree.XPath(
+    "//w:txbxContent//w:p//w:t",
+    namespaces={"w": "http://schemas.openxmlformats.org/wordprocessingml/2006/main"},
+)
+
 
 def get_pdf_and_docx_files(directory):
     """
@@ -46,11 +60,8 @@ def extract_text_from_pdf(filepath):
     - str: The extracted text.
     """
     try:
-        doc = pymupdf.open(filepath)
-        text = ""
-        for page in doc:
-            text += page.get_text()
-        return text
+        with pymupdf.open(filepath) as doc:
+            return "".join(page.get_text() for page in doc)
     except Exception as e:
         logging.error(f"Error reading the PDF: {e}")
         return ""
@@ -69,32 +80,10 @@ def extract_textboxes_from_docx(doc):
     text = []
     seen_texts = set()
 
-    doc_xml = doc.element.xml
-    root = etree.fromstring(doc_xml.encode("utf-8"))
-
-    for shape in root.xpath(
-        "//w:txbxContent",
-        namespaces={
-            "w": "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
-        },
-    ):
-        for paragraph in shape.xpath(
-            ".//w:p",
-            namespaces={
-                "w": "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
-            },
-        ):
-            text_elements = paragraph.xpath(
-                ".//w:t",
-                namespaces={
-                    "w": "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
-                },
-            )
-            for t in text_elements:
-                if t.text:
-                    if t.text and t.text not in seen_texts:
-                        seen_texts.add(t.text)
-                        text.append(t.text)
+    for t in TEXTBOX_TEXT_XPATH(doc.element):
+        if t.text and t.text not in seen_texts:
+            seen_texts.add(t.text)
+            text.append(t.text)
 
     return "\n".join(text)
 
@@ -143,10 +132,7 @@ def normalize_text(text):
     Returns:
     - str: The normalized text.
     """
-    text = text.strip()
-    text = re.sub(r"\s+", " ", text)
-    text = text.lower()
-    return text
+    return WHITESPACE_PATTERN.sub(" ", text).strip().lower()
 
 
 def capitalize_author(prefix, author):
@@ -167,6 +153,8 @@ def extract_metadata(text):
     """
     Extracts metadata such as the date and author from the document text.
 
+    Dates and authors are collected in a single scan of the normalized text.
+
     Args:
     - text (str): The text of the document.
 
@@ -178,20 +166,22 @@ def extract_metadata(text):
 
     normalized_text = normalize_text(text)
 
-    date_pattern = r"\b\d{2}/\d{2}/\d{4}\b"
-    dates = re.findall(date_pattern, normalized_text)
     document_date = None
-
-    for date_str in dates:
-        date_obj = datetime.strptime(date_str, "%d/%m/%Y")
-        if date_obj.year >= 2001:
-            document_date = datetime.strftime(date_obj, "%d/%m/%Y")
-            break
-
-    author_pattern = r"\b(dr)\s+([a-z]+(?:\s+[a-z]+)?)\b"
-    author_matches = re.findall(author_pattern, normalized_text)
-    if author_matches:
-        last_author = author_matches[-1]
+    last_author = None
+
+    for match in METADATA_PATTERN.finditer(normalized_text):
+        date_str = match.group("date")
+        if date_str:
+            if document_date is None and int(date_str[-4:]) >= 2001:
+                try:
+                    datetime.strptime(date_str, "%d/%m/%Y")
+                except ValueError:
+                    continue
+                document_date = date_str
+        else:
+            last_author = match.group("prefix", "author")
+
+    if last_author:
         prefix, full_name = last_author
         full_name = full_name.split("dr")[0]
         author = capitalize_author(prefix, full_name)
@@ -201,23 +191,120 @@ def extract_metadata(text):
     return document_date, author
 
 
-def get_patient_info(conn, ipp):
+def get_patient_nums(conn, ipps):
     """
-    Retrieves patient information from the DWH_PATIENT_IPPHIST table.
+    Retrieves the patient numbers of several IPPs from the DWH_PATIENT_IPPHIST table.
+
+    The IPPs are looked up with IN queries, in batches that stay below SQLite's
+    limit on the number of bound parameters.
+    When an IPP has several rows, the one from the latest upload is used.
 
     Args:
     - conn (sqlite3.Connection): The connection to the database.
-    - ipp (str): The IPP (Identifiant Patient Principal) of the patient.
+    - ipps (iterable): The IPPs (Identifiant Patient Principal) of the patients.
+
+    Returns:
+    - dict: A dictionary mapping each IPP found in the table to its patient number.
+    """
+    ipps = list(set(ipps))
+    patient_nums = {}
+
+    for start in range(0, len(ipps), SQLITE_MAX_VARIABLES):
+        batch = ipps[start : start + SQLITE_MAX_VARIABLES]
+        query = (
+            "SELECT HOSPITAL_PATIENT_ID, PATIENT_NUM FROM DWH_PATIENT_IPPHIST "
+            f"WHERE HOSPITAL_PATIENT_ID IN ({', '.join('?' for _ in batch)}) "
+            "ORDER BY UPLOAD_ID, rowid"
+        )
+        for ipp, patient_num in conn.execute(query, batch):
+            patient_nums[ipp] = patient_num
+
+    return patient_nums
+
+
+def process_file(file_path):
+    """
+    Extracts the text and metadata of a PDF or DOCX file.
+
+    Args:
+    - file_path (str): The path to the file.
+
+    Returns:
+    - tuple: A tuple containing the document origin code, the extracted text,
+      the document date and the author.
+    """
+    document_origin_code = None
+    displayed_text = ""
+
+    if file_path.endswith(".pdf"):
+        displayed_text = extract_text_from_pdf(file_path)
+        document_origin_code = "DOSSIER_PATIENT"
+    elif file_path.endswith(".docx"):
+        displayed_text = extract_text_from_docx(file_path)
+        document_origin_code = "RADIOLOGIE_SOFTWARE"
+
+    document_date, author = extract_metadata(displayed_text)
+    return document_origin_code, displayed_text, document_date, author
+
+
+def get_document_num(file):
+    """
+    Computes a stable document number from the name of a file.
+
+    Args:
+    - file (str): The name of the file.
+
+    Returns:
+    - int: A positive integer that fits in a SQLite INTEGER column.
+    """
+    digest = hashlib.blake2b(file.encode("utf-8"), digest_size=7).digest()
+    return int.from_bytes(digest, "little")
+
+
+def process_files(file_paths):
+    """
+    Extracts the text and metadata of several files, reusing cached results.
+
+    Results are cached on disk by file path together with the file's
+    modification time, so unchanged files are not read again, even after a
+    restart. The remaining files are processed in a pool of worker processes
+    sized to their number, or inline when there is only one.
+
+    Args:
+    - file_paths (list): The paths to the files.
 
     Returns:
-    - tuple: A tuple containing the patient information retrieved from the database.
+    - list: The results of `process_file`, in the same order as file_paths.
     """
-    query = "SELECT * FROM DWH_PATIENT_IPPHIST WHERE HOSPITAL_PATIENT_ID = ?"
-    cursor = conn.execute(query, (ipp,))
-    return cursor.fetchone()
+    results = {}
+
+    with shelve.open(TEXT_CACHE_PATH) as cache:
+        mtimes = {file_path: os.path.getmtime(file_path) for file_path in file_paths}
+        missing_paths = []
 
+        for file_path in file_paths:
+            cached = cache.get(file_path)
+            if cached and cached[0] == mtimes[file_path]:
+                results[file_path] = cached[1]
+            else:
+                missing_paths.append(file_path)
 
-def get_document_data(directory, upload_id, conn):
+        if len(missing_paths) > 1:
+            max_workers = min(len(missing_paths), os.cpu_count() or 1)
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                missing_results = list(executor.map(process_file, missing_paths))
+        else:
+            missing_results = [process_file(file_path) for file_path in missing_paths]
+
+        for file_path, result in zip(missing_paths, missing_results):
+            results[file_path] = result
+            if result[1]:
+                cache[file_path] = (mtimes[file_path], result)
+
+    return [results[file_path] for file_path in file_paths]
+
+
+def get_document_data(directory, upload_id, conn, files=None):
     """
     Processes PDF and DOCX files in a directory and extracts their metadata.
 
@@ -225,41 +312,40 @@ def get_document_data(directory, upload_id, conn):
     - directory (str): The path to the directory containing the files.
     - upload_id (int): The upload ID to associate with the records.
     - conn (sqlite3.Connection): The connection to the database.
+    - files (iterable, optional): The names of the files to process. Defaults
+      to every PDF and DOCX file in the directory.
 
     Returns:
     - list: A list of dictionaries containing document data.
     """
-    files = get_pdf_and_docx_files(directory)
-    document_num = 1
+    if files is None:
+        files = get_pdf_and_docx_files(directory)
+    files = [file for file in files if os.path.isfile(os.path.join(directory, file))]
+    file_paths = [os.path.join(directory, file) for file in files]
     documents = []
 
-    for file in files:
-        file_path = os.path.join(directory, file)
+    results = process_files(file_paths)
+    patient_nums = get_patient_nums(
+        conn, (os.path.splitext(file)[0].split("_")[0] for file in files)
+    )
+
+    for file, result in zip(files, results):
+        document_origin_code, displayed_text, document_date, author = result
         file_name, file_extension = os.path.splitext(file)
         ipp, id_document = file_name.split("_")
-        displayed_text = ""
-
-        if file_extension == ".pdf":
-            displayed_text = extract_text_from_pdf(file_path)
-            document_origin_code = "DOSSIER_PATIENT"
-        elif file_extension == ".docx":
-            displayed_text = extract_text_from_docx(file_path)
-            document_origin_code = "RADIOLOGIE_SOFTWARE"
 
         if not displayed_text:
             logging.warning(f"The file {file} is empty or could not be read.")
             continue
 
-        document_date, author = extract_metadata(displayed_text)
-
-        patient_info = get_patient_info(conn, ipp)
-        if not patient_info:
+        patient_num = patient_nums.get(ipp)
+        if patient_num is None:
             logging.warning(f"No information found for the patient: {ipp}")
             continue
 
         document_dict = {
-            "DOCUMENT_NUM": document_num,
-            "PATIENT_NUM": patient_info[0],
+            "DOCUMENT_NUM": get_document_num(file),
+            "PATIENT_NUM": patient_num,
             "ENCOUNTER_NUM": None,
             "TITLE": None,
             "DOCUMENT_ORIGIN_CODE": document_origin_code,
@@ -279,59 +365,102 @@ def get_document_data(directory, upload_id, conn):
         }
 
         documents.append(document_dict)
-        document_num += 1
 
     return documents
 
 
-def update_existing_doc_data(df, table_name, conn):
+def remove_documents(directory, files, conn):
     """
-    Updates existing records in a database table with data from a DataFrame.
+    Removes the documents of files that no longer exist.
+
+    Their rows are deleted from DWH_DOCUMENT and their entries from the text
+    cache.
 
     Args:
-    - df (pd.DataFrame): The DataFrame containing the data to update.
-    - table_name (str): The name of the target table.
+    - directory (str): The path to the directory that contained the files.
+    - files (list): The names of the removed files.
     - conn (sqlite3.Connection): The connection to the database.
 
     Returns:
     - None
     """
-    for _, row in df.iterrows():
-        placeholders = ", ".join(
-            [f"{col} = ?" for col in row.index if col != "DOCUMENT_NUM"]
-        )
-        query = f"UPDATE {table_name} SET {placeholders} WHERE DOCUMENT_NUM = ?"
-        params = tuple(row[col] for col in row.index if col != "DOCUMENT_NUM") + (
-            row["DOCUMENT_NUM"],
+    with conn:
+        conn.executemany(
+            "DELETE FROM DWH_DOCUMENT WHERE DOCUMENT_NUM = ?",
+            [(get_document_num(file),) for file in files],
         )
-        conn.execute(query, params)
-    conn.commit()
+
+    with shelve.open(TEXT_CACHE_PATH) as cache:
+        for file in files:
+            cache.pop(os.path.join(directory, file), None)
+
+
+def prune_text_cache():
+    """
+    Drops the text cache entries of files that no longer exist.
+
+    Returns:
+    - None
+    """
+    with shelve.open(TEXT_CACHE_PATH) as cache:
+        for file_path in list(cache):
+            if not os.path.isfile(file_path):
+                del cache[file_path]
 
 
-def update_document_data(directory, upload_id, conn):
+def update_document_data(directory, upload_id, conn, files=None):
     """
     Updates the DWH_DOCUMENT table with data extracted from PDF and DOCX files.
 
+    When the whole directory is processed, rows whose DOCUMENT_NUM does not
+    match any file in it, including rows keyed by an older numbering, are
+    deleted, as are rows whose patient is no longer in DWH_PATIENT. When only
+    some files are processed, the rows of those that no longer exist are
+    deleted.
+
     Args:
     - directory (str): The path to the directory containing the files.
     - upload_id (int): The upload ID to associate with the records.
     - conn (sqlite3.Connection): The connection to the database.
+    - files (iterable, optional): The names of the files to process. Defaults
+      to every PDF and DOCX file in the directory.
 
     Returns:
     - None
     """
     try:
-        document_data = get_document_data(directory, upload_id, conn)
-        df_documents = pd.DataFrame(document_data)
-
-        existing_documents = pd.read_sql_query("SELECT * FROM DWH_DOCUMENT", conn)
-
-        new_documents = df_documents[
-            ~df_documents["DOCUMENT_NUM"].isin(existing_documents["DOCUMENT_NUM"])
-        ]
-
-        update_existing_doc_data(df_documents, "DWH_DOCUMENT", conn)
-        insert_new_data(new_documents, "DWH_DOCUMENT", conn)
+        full_scan = files is None
+        if full_scan:
+            files = get_pdf_and_docx_files(directory)
+        else:
+            files = list(files)
+            removed_files = [
+                file
+                for file in files
+                if not os.path.isfile(os.path.join(directory, file))
+            ]
+            if removed_files:
+                logging.info(f"Removing documents of missing files: {removed_files}")
+                remove_documents(directory, removed_files, conn)
+
+        document_data = get_document_data(directory, upload_id, conn, files)
+
+        if document_data:
+            columns = list(document_data[0])
+            rows = [
+                tuple(document[col] for col in columns) for document in document_data
+            ]
+            upsert_rows(rows, columns, "DWH_DOCUMENT", "DOCUMENT_NUM", conn)
+
+        if full_scan:
+            document_nums = [get_document_num(file) for file in files]
+            delete_stale_data(document_nums, "DWH_DOCUMENT", "DOCUMENT_NUM", conn)
+            with conn:
+                conn.execute(
+                    "DELETE FROM DWH_DOCUMENT "
+                    "WHERE PATIENT_NUM NOT IN (SELECT PATIENT_NUM FROM DWH_PATIENT)"
+                )
+            prune_text_cache()
 
         logging.info("Update successful.")
 
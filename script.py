@@ -1,7 +1,11 @@
+import hashlib
 import logging
 import os
+import queue
 import sqlite3
-import time
+
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
 
 from exo_1 import update_patient_data
 from exo_2 import update_document_data
@@ -13,116 +17,177 @@ logging.basicConfig(
 directory = "fichiers source"
 excel_file = "export_patient.xlsx"
 excel_path = os.path.join(directory, excel_file)
+settle_delay = 1
 
 
-def get_current_files_with_timestamps(directory):
+def is_source_file(filename):
     """
-    Returns a dictionary of the current files with their timestamps in the specified directory.
+    Checks whether a file is one of the monitored source files.
 
     Args:
-    - directory (str): The path to the directory.
+    - filename (str): The name of the file.
 
     Returns:
-    - dict: A dictionary where the keys are filenames and the values are their last modified timestamps.
+    - bool: True if the file is the Excel export or a PDF or DOCX file.
     """
-    return {
-        filename: os.path.getmtime(os.path.join(directory, filename))
-        for filename in os.listdir(directory)
-        if filename.endswith((".pdf", ".docx"))
-    }
+    return filename == excel_file or filename.endswith((".pdf", ".docx"))
 
 
-def has_changes(directory, last_seen_files):
+class SourceFileHandler(FileSystemEventHandler):
+    """
+    Pushes the names of created, modified, deleted or moved source files onto a
+    queue.
     """
-    Checks for new files, deleted files, or modified files in the directory.
+
+    def __init__(self, changes):
+        """
+        Args:
+        - changes (queue.Queue): The queue receiving the names of changed files.
+        """
+        super().__init__()
+        self.changes = changes
+
+    def push(self, path):
+        filename = os.path.basename(path)
+        if is_source_file(filename):
+            self.changes.put(filename)
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.push(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.push(event.src_path)
+
+    def on_deleted(self, event):
+        if not event.is_directory:
+            self.push(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self.push(event.src_path)
+            self.push(event.dest_path)
+
+
+def get_file_digest(path):
+    """
+    Computes the SHA-256 digest of a file's content.
 
     Args:
-    - directory (str): The path to the directory.
-    - last_seen_files (dict): A dictionary of previously seen files with their timestamps.
+    - path (str): The path to the file.
 
     Returns:
-    - tuple: A tuple containing sets of new files, deleted files, modified files, and the current files with their timestamps.
+    - str: The hexadecimal digest, or None if the file does not exist.
+    """
+    try:
+        with open(path, "rb") as f:
+            return hashlib.file_digest(f, "sha256").hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def wait_for_changes(changes):
     """
-    current_files = get_current_files_with_timestamps(directory)
-    new_files = set(current_files.keys()) - set(last_seen_files.keys())
-    deleted_files = set(last_seen_files.keys()) - set(current_files.keys())
+    Blocks until a source file changes, then collects the changes that follow.
 
-    modified_files = {
-        filename
-        for filename in current_files
-        if filename in last_seen_files
-        and current_files[filename] != last_seen_files[filename]
-    }
+    Saving a file usually fires several events, so the queue is drained until
+    no new event arrives for `settle_delay` seconds.
 
-    return new_files, deleted_files, modified_files, current_files
+    Args:
+    - changes (queue.Queue): The queue receiving the names of changed files.
+
+    Returns:
+    - set: The names of the files that changed.
+    """
+    changed_files = {changes.get()}
+    while True:
+        try:
+            changed_files.add(changes.get(timeout=settle_delay))
+        except queue.Empty:
+            return changed_files
 
 
 def main():
     upload_id_patient = 1
     upload_id_document = 1
-    last_seen_files = get_current_files_with_timestamps(directory)
+    changes = queue.Queue()
+
+    observer = Observer()
+    observer.schedule(SourceFileHandler(changes), directory)
+    observer.start()
 
     try:
-        excel_last_modified_time = os.path.getmtime(excel_path)
+        excel_digest = None
+        logging.info("Initializing tables DWH_PATIENT and DWH_PATIENT_IPPHIST...")
+        current_excel_digest = get_file_digest(excel_path)
+        if update_patient_data(upload_id_patient, conn):
+            excel_digest = current_excel_digest
+        upload_id_patient += 1
+        logging.info(
+            "Updating of tables DWH_PATIENT and DWH_PATIENT_IPPHIST completed."
+        )
+
+        logging.info("Initializing the DWH_DOCUMENT table...")
+        update_document_data(directory, upload_id_document, conn)
+        upload_id_document += 1
+        logging.info("Update of the DWH_DOCUMENT table completed.")
 
         while True:
-            logging.info("Checking for file changes...")
-
-            new_files, deleted_files, modified_files, last_seen_files = has_changes(
-                directory, last_seen_files
-            )
-            excel_current_modified_time = os.path.getmtime(excel_path)
-
-            if (
-                excel_current_modified_time != excel_last_modified_time
-                or upload_id_patient == 1
-            ):
-                if upload_id_patient == 1:
-                    logging.info(
-                        "Initializing tables DWH_PATIENT and DWH_PATIENT_IPPHIST..."
-                    )
+            logging.info("Waiting for file changes...")
+            changed_files = wait_for_changes(changes)
+            patients_updated = False
+
+            if excel_file in changed_files:
+                current_excel_digest = get_file_digest(excel_path)
+                if current_excel_digest is None:
+                    logging.warning("The Excel file could not be found.")
+                elif current_excel_digest == excel_digest:
+                    logging.info("The Excel file content is unchanged.")
                 else:
                     logging.info(
                         "The Excel file has been modified, updating in progress..."
                     )
+                    if update_patient_data(upload_id_patient, conn):
+                        excel_digest = current_excel_digest
+                        patients_updated = True
+                    upload_id_patient += 1
+                    logging.info(
+                        "Updating of tables DWH_PATIENT and DWH_PATIENT_IPPHIST completed."
+                    )
 
-                update_patient_data(upload_id_patient, conn)
-                excel_last_modified_time = excel_current_modified_time
-                upload_id_patient += 1
-
-                logging.info(
-                    "Updating of tables DWH_PATIENT and DWH_PATIENT_IPPHIST completed."
-                )
-
-            if new_files or deleted_files or modified_files or upload_id_document == 1:
-                if upload_id_document == 1:
-                    logging.info("Initializing the DWH_DOCUMENT table...")
-
-                if new_files:
-                    logging.info(f"New files detected: {new_files}")
-
-                if deleted_files:
-                    logging.info(f"Deleted files detected: {deleted_files}")
-
-                if modified_files:
-                    logging.info(f"Modified files detected: {modified_files}")
-
+            changed_documents = changed_files - {excel_file}
+            if patients_updated:
+                logging.info("Reprocessing all documents for the updated patients...")
                 update_document_data(directory, upload_id_document, conn)
                 upload_id_document += 1
                 logging.info("Update of the DWH_DOCUMENT table completed.")
-
-            else:
-                logging.info("No changes found.")
-
-            time.sleep(30)
+            elif changed_documents:
+                logging.info(f"Changed files detected: {changed_documents}")
+                update_document_data(
+                    directory, upload_id_document, conn, changed_documents
+                )
+                upload_id_document += 1
+                logging.info("Update of the DWH_DOCUMENT table completed.")
 
     except Exception as e:
         logging.error(f"Error in the main loop: {e}")
 
+    finally:
+        observer.stop()
+        observer.join()
+
 
 if __name__ == "__main__":
     try:
         conn = sqlite3.connect("drwh.db")
+        conn.executescript(
+            "PRAGMA journal_mode=WAL;"
+            "PRAGMA synchronous=NORMAL;"
+            "PRAGMA temp_store=MEMORY;"
+            "PRAGMA cache_size=-200000;"
+            "PRAGMA mmap_size=1073741824;"
+        )
         main()
     except sqlite3.Error as e:
         logging.error(f"Error connecting to the database: {e}")